@@ -68,7 +68,9 @@ async def sequential_forward(
                 span = sequences.popleft()
 
                 stub = TransformerConnectionHandler.get_stub(sequence_manager.p2p, span.peer_id)
-                inputs_and_prompts = [inputs, prompts[span.start : span.end]]
+                # If there are no prompts, send the dummy tensor as is instead of slicing it per span
+                span_prompts = prompts if is_dummy(prompts) else prompts[span.start : span.end]
+                inputs_and_prompts = [inputs, span_prompts]
 
                 span_uids = CHAIN_DELIMITER.join(sequence_manager.block_uids[span.start : span.end])
                 metadata = sequence_manager.get_request_metadata("rpc_forward", span_uids, *inputs_and_prompts)
@@ -1,11 +1,18 @@
 import fcntl
+import functools
 import json
+import math
 import os
+import socket
+import threading
 import time
+import uuid
+import zlib
 from collections import Counter
-from hashlib import sha256
+from concurrent.futures import Future, ThreadPoolExecutor
+from concurrent.futures import TimeoutError as FutureTimeoutError
 from pathlib import Path
-from typing import Optional, Sequence, Union
+from typing import Dict, List, Optional, Sequence, Tuple, Union
 
 import torch
 from hivemind.utils.logging import get_logger
@@ -19,24 +26,42 @@ from petals.utils.disk_cache import DEFAULT_CACHE_DIR
 logger = get_logger(__file__)
 
 try:
-    import speedtest
+    # orjson parses and serializes in native code, shrinking the time spent under the cache lock.
+    # It is optional: the stdlib json module is used if it is not installed
+    import orjson
+
+    def _json_loads(data: bytes) -> dict:
+        return orjson.loads(data)
+
+    def _json_dumps(obj: dict) -> bytes:
+        return orjson.dumps(obj)
+
 except ImportError:
-    raise ImportError("Please `pip install speedtest-cli==2.1.3`")
-
-if not hasattr(speedtest, "Speedtest"):
-    raise ImportError(
-        "You are using the wrong speedtest module. Please replace speedtest with speedtest-cli.\n"
-        "To do that, run `pip uninstall -y speedtest`. Depending on your python environment, "
-        "you may need to run uninstall speedtest two or more times, until it says 'not installed'.\n"
-        "After that, please `pip install speedtest-cli==2.1.3` to install the correct version."
-    )
 
+    def _json_loads(data: bytes) -> dict:
+        return json.loads(data)
+
+    def _json_dumps(obj: dict) -> bytes:
+        return json.dumps(obj).encode()
+
+
+# Process-level cache of final throughput values, so that repeated calls with the same arguments
+# skip the file lock and JSON parsing entirely
+_IN_MEMORY_CACHE: Dict[Tuple[str, int], float] = {}
+
+# Cached network measurements older than this are remeasured (network conditions drift over time)
+NETWORK_CACHE_TTL = 24 * 60 * 60
+
+# A speedtest running longer than this is treated as hung: we hold the cache lock while waiting,
+# so an unbounded wait would stall every other boot on the host
+NETWORK_MEASUREMENT_TIMEOUT = 5 * 60
 
 def get_host_throughput(
     config: BloomConfig,
     device: torch.device,
     dtype: Union[str, torch.dtype],
     *,
+    num_blocks: int = 1,
     load_in_8bit: bool,
     tensor_parallel_devices: Sequence[torch.device],
     force_eval: bool = False,
@@ -44,95 +69,244 @@ def get_host_throughput(
 ) -> float:
     dtype = resolve_block_dtype(config, dtype)
 
+    # The key hashes only the fields that actually affect throughput, so it survives
+    # irrelevant config changes such as transformers_version bumps across pip upgrades
+    config_fields = (
+        config.hidden_size,
+        config.n_head,
+        config.n_layer,
+        getattr(config, "slow_but_exact", None),
+        getattr(config, "pretraining_tp", 1),
+    )
+    device_name = get_device_name(device).replace(" ", "_")
+    dtype_name = get_dtype_name(dtype, load_in_8bit)
+    # The hash is only a short deterministic key for the JSON cache, so crc32 is plenty —
+    # cryptographic strength would buy nothing here
+    compute_cache_key = f"config_{zlib.crc32(repr(config_fields).encode()):08x}"
+    compute_cache_key += f"_device_{device_name}_dtype_{dtype_name}"
+    if len(tensor_parallel_devices) > 1:
+        # Only the number of devices of each kind matters for throughput, not their order,
+        # so permutations of the same tensor-parallel config share one cache entry
+        tp_counts = Counter(get_device_name(device_i) for device_i in tensor_parallel_devices)
+        compute_cache_key += "_tp_" + "_".join(
+            f"{count}x{name.replace(' ', '_')}" for name, count in sorted(tp_counts.items())
+        )
+    # Network speed is a property of the host, not the model, so its cache is keyed on the machine
+    # identity and the raw bandwidth is shared across model configs until the measurement goes stale
+    network_cache_key = f"host_{zlib.crc32(repr((socket.gethostname(), uuid.getnode())).encode()):08x}"
+
+    # The override applies whether or not a cached measurement exists, and is validated eagerly here
+    # so that a malformed value surfaces to the user instead of failing inside a worker thread
+    network_bps_override = _network_bps_override()
+
+    if not force_eval and (compute_cache_key, num_blocks) in _IN_MEMORY_CACHE:
+        return _IN_MEMORY_CACHE[compute_cache_key, num_blocks]
+
     if cache_dir is None:
         cache_dir = DEFAULT_CACHE_DIR
     lock_path = Path(cache_dir, "throughput.lock")
-    cache_path = Path(cache_dir, "throughput_v2.json")
+    compute_cache_path = Path(cache_dir, "compute_v2.json")
+    network_cache_path = Path(cache_dir, "network_v2.json")
 
-    # We use the system-wide lock since only one process at a time can measure the host throughput
     os.makedirs(lock_path.parent, exist_ok=True)
     with open(lock_path, "wb") as lock_fd:
         logger.info("Loading throughput info")
-        fcntl.flock(lock_fd.fileno(), fcntl.LOCK_EX)
+        # Readers take a shared lock, so that concurrent warm boots on the same host proceed in parallel.
         # The OS will release the lock when lock_fd is closed or the process is killed
-
-        cache_key = f"config_{sha256(str(config).encode()).hexdigest()[-16:]}"
-        cache_key += f"_device_{get_device_name(device).replace(' ', '_')}"
-        cache_key += f"_dtype_{get_dtype_name(dtype, load_in_8bit)}"
-        if len(tensor_parallel_devices) > 1:
-            for i, device_i in enumerate(tensor_parallel_devices):
-                cache_key += f"_tp{i}_{get_device_name(device_i).replace(' ', '_')}"
-
-        cache = {}
-        try:
-            if not force_eval and os.path.exists(cache_path):
-                with open(cache_path) as cache_fd:
-                    cache = json.load(cache_fd)
-                assert isinstance(cache, dict)
-        except Exception:
-            logger.exception(f"Failed to read throughput info from {cache_path}")
-            cache = {}
-
-        if cache_key not in cache:
-            cache[cache_key] = measure_throughput_info(
+        fcntl.flock(lock_fd.fileno(), fcntl.LOCK_SH)
+
+        compute_cache = _read_cache(compute_cache_path)
+        network_cache = _read_cache(network_cache_path)
+        if force_eval:
+            compute_cache.pop(compute_cache_key, None)
+            network_cache.pop(network_cache_key, None)
+        network_bps = network_bps_override
+        if network_bps is None:
+            network_bps = _fresh_network_bps(network_cache, network_cache_key)
+
+        if compute_cache_key not in compute_cache or network_bps is None:
+            # Only one process at a time can measure the host throughput. Promote to an exclusive lock
+            # and re-read the caches: another process may have filled them while we were waiting
+            fcntl.flock(lock_fd.fileno(), fcntl.LOCK_EX)
+            compute_cache = _read_cache(compute_cache_path)
+            network_cache = _read_cache(network_cache_path)
+            if force_eval:
+                compute_cache.pop(compute_cache_key, None)
+                network_cache.pop(network_cache_key, None)
+            if network_bps is None:
+                network_bps = _fresh_network_bps(network_cache, network_cache_key)
+
+        # The speedtest mostly sleeps in socket I/O and the compute probe releases the GIL inside
+        # CUDA/BLAS kernels, so the two measurements can overlap on a background thread
+        network_future = None
+        if network_bps is None:
+            network_future = _measure_network_bps_in_background()
+
+        if compute_cache_key not in compute_cache:
+            logger.info("Measuring compute throughput. This takes about a minute and will be cached for future runs")
+            compute_cache[compute_cache_key] = measure_compute_rps(
                 config, device, dtype, load_in_8bit=load_in_8bit, tensor_parallel_devices=tensor_parallel_devices
             )
+            _save_cache(compute_cache_path, compute_cache)
 
+        # Network throughput is cached separately, so that a failed speedtest
+        # does not invalidate the compute measurement (and vice versa)
+        if network_future is not None:
             try:
-                os.makedirs(cache_path.parent, exist_ok=True)
-                with open(cache_path, "w") as cache_fd:
-                    json.dump(cache, cache_fd)
-            except Exception:
-                logger.exception(f"Failed to save throughput info in {cache_path}")
-
-    return cache[cache_key]
+                network_bps = network_future.result(timeout=NETWORK_MEASUREMENT_TIMEOUT)
+                network_cache[network_cache_key] = {"bits_per_second": network_bps, "timestamp": time.time()}
+                _save_cache(network_cache_path, network_cache)
+            except (ValueError, OSError, RuntimeError, FutureTimeoutError):
+                logger.warning("Failed to measure network throughput:", exc_info=True)
+                logger.warning("Proceeding with the compute throughput only")
+
+    compute_rps = compute_cache[compute_cache_key]
+    network_rps = measure_network_rps(config, bits_per_second=network_bps) if network_bps else None
+    if network_rps is None:
+        result = compute_rps
+    else:
+        # Servers hosting many blocks send one request over the network per several forward passes,
+        # so the network link is amortized across blocks (see bigscience-workshop/petals#192)
+        result = min(compute_rps, network_rps * min(num_blocks, 5))
+    _IN_MEMORY_CACHE[compute_cache_key, num_blocks] = result
+    return result
 
 
-def measure_throughput_info(
-    config: BloomConfig,
-    device: torch.device,
-    dtype: torch.dtype,
-    *,
-    load_in_8bit: bool,
-    tensor_parallel_devices: Sequence[torch.device],
-) -> float:
-    """Measure network and compute throughput in forward pass tokens per second"""
+def _read_cache(cache_path: Path) -> dict:
+    cache = {}
+    try:
+        if os.path.exists(cache_path):
+            with open(cache_path, "rb") as cache_fd:
+                cache = _json_loads(cache_fd.read())
+            assert isinstance(cache, dict)
+    except Exception:
+        logger.exception(f"Failed to read throughput info from {cache_path}")
+        cache = {}
+    return cache
 
-    logger.info(
-        "Measuring network and compute throughput. This takes about a minute and will be cached for future runs"
-    )
 
-    result = measure_compute_rps(
-        config, device, dtype, load_in_8bit=load_in_8bit, tensor_parallel_devices=tensor_parallel_devices
-    )
+def _save_cache(cache_path: Path, cache: dict) -> None:
+    # Write to a tempfile, then rename atomically: if the process is killed mid-write
+    # (e.g. by the OOM killer), readers see either the old cache or the new one, never a truncated file
+    tmp_path = cache_path.with_name(f"{cache_path.name}.tmp.{os.getpid()}")
     try:
-        result = min(result, measure_network_rps(config))
+        os.makedirs(cache_path.parent, exist_ok=True)
+        with open(tmp_path, "wb") as cache_fd:
+            cache_fd.write(_json_dumps(cache))
+            cache_fd.flush()
+            os.fsync(cache_fd.fileno())
+        os.replace(tmp_path, cache_path)
     except Exception:
-        logger.warning("Failed to measure network throughput:", exc_info=True)
-        logger.warning("Proceeding with the compute throughput only")
-    return result
+        logger.exception(f"Failed to save throughput info in {cache_path}")
+        try:
+            os.unlink(tmp_path)
+        except OSError:
+            pass
+
+
+def _fresh_network_bps(network_cache: dict, network_cache_key: str) -> Optional[float]:
+    entry = network_cache.get(network_cache_key)
+    # A zero entry is a failed measurement, not a valid one: treat it as stale so the next boot retries
+    if (
+        isinstance(entry, dict)
+        and entry.get("bits_per_second")
+        and time.time() - entry.get("timestamp", 0) < NETWORK_CACHE_TTL
+    ):
+        return entry["bits_per_second"]
+    return None
 
 
-def measure_network_rps(config: BloomConfig) -> Optional[float]:
-    s = speedtest.Speedtest()
-    s.get_servers()
-    s.get_best_server()
-    s.download()
-    s.upload()
-    network_info = s.results.dict()
+def measure_network_rps(config: BloomConfig, *, bits_per_second: Optional[float] = None) -> Optional[float]:
+    if bits_per_second is None:
+        bits_per_second = _measure_network_bits_per_second()
 
     bits_per_request = config.hidden_size * 16  # Clients usually send 16-bit tensors for forward/backward
-    network_rps = min(network_info["download"], network_info["upload"]) / bits_per_request
+    network_rps = bits_per_second / bits_per_request
     if network_rps == 0:
         raise ValueError("speedtest has returned network_rps == 0")
 
+    logger.info(f"Network throughput: {bits_per_second / 1e6:.2f} Mbit/s, {network_rps:.1f} RPS")
+    return network_rps
+
+
+def _network_bps_override() -> Optional[float]:
+    override_mbps = os.environ.get("PETALS_NETWORK_RPS_MBPS")
+    if override_mbps is None:
+        return None
+    try:
+        override_bps = float(override_mbps) * 1e6
+    except ValueError:
+        raise ValueError(f"Failed to parse PETALS_NETWORK_RPS_MBPS={override_mbps!r}, must be a number of Mbit/s")
+    logger.info(f"Network throughput is overridden to {override_bps / 1e6:.2f} Mbit/s")
+    return override_bps
+
+
+def _measure_network_bps_in_background() -> Future:
+    # The measurement runs on a plain daemon thread instead of a ThreadPoolExecutor worker:
+    # executor threads are joined at interpreter exit, so a speedtest hung past the timeout
+    # would block process shutdown
+    future = Future()
+
+    def _worker():
+        if not future.set_running_or_notify_cancel():
+            return
+        try:
+            future.set_result(_measure_network_bits_per_second())
+        except BaseException as e:
+            future.set_exception(e)
+
+    threading.Thread(target=_worker, name="MeasureNetworkBps", daemon=True).start()
+    return future
+
+
+def _measure_network_bits_per_second() -> float:
+    override_bps = _network_bps_override()
+    if override_bps is not None:
+        return override_bps
+
+    speedtest = _load_speedtest()
+    try:
+        s = speedtest.Speedtest()
+        s.get_servers()
+        s.get_best_server()
+        # Download and upload measure different directions of the same link, so they can run concurrently
+        with ThreadPoolExecutor(max_workers=2) as executor:
+            download_future = executor.submit(s.download)
+            upload_future = executor.submit(s.upload)
+            download_future.result()
+            upload_future.result()
+        network_info = s.results.dict()
+    except speedtest.SpeedtestException as e:
+        raise RuntimeError(f"speedtest failed: {repr(e)}") from e
+
+    bits_per_second = min(network_info["download"], network_info["upload"])
+    if bits_per_second == 0:
+        raise ValueError("speedtest has returned zero bandwidth")
+
     logger.info(
-        f"Network throughput: "
+        f"Measured network throughput: "
         f"{network_info['download'] / 1e6:.2f} Mbit/s on download, "
-        f"{network_info['upload'] / 1e6:.2f} Mbit/s on upload, "
-        f"{network_rps:.1f} RPS"
+        f"{network_info['upload'] / 1e6:.2f} Mbit/s on upload"
     )
-    return network_rps
+    return bits_per_second
+
+
+def _load_speedtest():
+    # The speedtest library takes tens of milliseconds to import and only the network probe needs it,
+    # so it is imported lazily and clients never pay for it
+    try:
+        import speedtest
+    except ImportError:
+        raise ImportError("Please `pip install speedtest-cli==2.1.3`")
+
+    if not hasattr(speedtest, "Speedtest"):
+        raise ImportError(
+            "You are using the wrong speedtest module. Please replace speedtest with speedtest-cli.\n"
+            "To do that, run `pip uninstall -y speedtest`. Depending on your python environment, "
+            "you may need to run uninstall speedtest two or more times, until it says 'not installed'.\n"
+            "After that, please `pip install speedtest-cli==2.1.3` to install the correct version."
+        )
+    return speedtest
 
 
 def measure_compute_rps(
@@ -147,20 +321,66 @@ def measure_compute_rps(
 ) -> float:
     if not tensor_parallel_devices:
         tensor_parallel_devices = (device,)
-    with torch.inference_mode():
-        block = WrappedBloomBlock(config).to(dtype)
-        block = convert_block(block, config, tensor_parallel_devices, device, load_in_8bit=load_in_8bit, freeze=True)
 
-        cache = None
-        elapsed = 0
-        for step in range(n_steps + 1):
-            dummy_input = torch.randn(n_tokens, 1, config.hidden_size, device=device, dtype=dtype)
+    # Block setup — including 8-bit quantization, the dominant cost on 8-bit paths — happens before
+    # the measurement, and the allocator is flushed afterwards so the timed forwards start from a
+    # clean CUDA memory state instead of one fragmented by the conversion
+    block = WrappedBloomBlock(config).to(dtype)
+    block = convert_block(block, config, tensor_parallel_devices, device, load_in_8bit=load_in_8bit, freeze=True)
+    if device.type == "cuda":
+        torch.cuda.synchronize(device)
+        torch.cuda.empty_cache()
 
-            start_time = time.perf_counter()
-            _, cache = block.forward(dummy_input, use_cache=True, layer_past=cache)
-            if step >= 1:  # Skip the 1st step to exclude the initialization time
-                elapsed += time.perf_counter() - start_time
-        device_rps = n_steps * n_tokens / elapsed
+    with torch.inference_mode():
+        # The input is allocated once outside the loop, so that the timings do not include allocator and RNG costs
+        dummy_input = torch.randn(n_tokens, 1, config.hidden_size, device=device, dtype=dtype)
+
+        # Instead of running a fixed number of steps, we stop as soon as the relative standard error
+        # of the mean step time, sqrt(var / n) / mean, falls below 1%. This finishes in a few dozen
+        # steps on fast stable hardware while still using the full budget on noisy shared hosts.
+        warmup_steps, min_steps, check_every, rel_ste_threshold = 10, 32, 16, 0.01
+
+        # The probe always runs on the same input shape, so let cuDNN autotune the fastest kernels
+        # for it during warmup (warmup is long enough for the autotuner to settle)
+        prev_cudnn_benchmark = torch.backends.cudnn.benchmark
+        torch.backends.cudnn.benchmark = True
+        try:
+            cache = None
+            samples: List[float] = []  # Per-step forward times, in seconds
+            pending_events: List[Tuple[torch.cuda.Event, torch.cuda.Event]] = []
+            for step in range(warmup_steps + n_steps):
+                if device.type == "cuda":
+                    # CUDA events are recorded on the device stream, so synchronizing once per convergence
+                    # check (rather than once per step) gives true device-side execution time without
+                    # per-step sync stalls distorting the measurement
+                    start_event = torch.cuda.Event(enable_timing=True)
+                    end_event = torch.cuda.Event(enable_timing=True)
+                    start_event.record()
+                    _, cache = block.forward(dummy_input, use_cache=True, layer_past=cache)
+                    end_event.record()
+                    if step >= warmup_steps:
+                        pending_events.append((start_event, end_event))
+                else:
+                    start_time = time.perf_counter()
+                    _, cache = block.forward(dummy_input, use_cache=True, layer_past=cache)
+                    if step >= warmup_steps:
+                        samples.append(time.perf_counter() - start_time)
+
+                n_timed_steps = len(samples) + len(pending_events)
+                if step >= warmup_steps and n_timed_steps % check_every == 0:
+                    if pending_events:
+                        torch.cuda.synchronize(device)
+                        # elapsed_time() is in milliseconds
+                        samples.extend(start.elapsed_time(end) / 1000 for start, end in pending_events)
+                        pending_events.clear()
+                    if len(samples) >= min_steps and _relative_ste(samples) < rel_ste_threshold:
+                        break
+            if pending_events:
+                torch.cuda.synchronize(device)
+                samples.extend(start.elapsed_time(end) / 1000 for start, end in pending_events)
+            device_rps = len(samples) * n_tokens / sum(samples)
+        finally:
+            torch.backends.cudnn.benchmark = prev_cudnn_benchmark
 
     devices_repr = get_device_name(device)
     if len(tensor_parallel_devices) > 1:
@@ -173,9 +393,19 @@ def measure_compute_rps(
     return device_rps
 
 
+def _relative_ste(samples: Sequence[float]) -> float:
+    """Standard error of the mean, relative to the mean itself"""
+    n = len(samples)
+    mean = sum(samples) / n
+    var = sum((sample - mean) ** 2 for sample in samples) / (n - 1)
+    return math.sqrt(var / n) / mean
+
+
+@functools.lru_cache(maxsize=None)
 def get_device_name(device: torch.device) -> str:
     return f"{torch.cuda.get_device_name(device)} GPU" if device.type == "cuda" else "CPU"
 
 
+@functools.lru_cache(maxsize=None)
 def get_dtype_name(dtype: torch.dtype, load_in_8bit: bool) -> str:
     return "8-bit" if load_in_8bit else str(dtype)
@@ -110,10 +110,13 @@ def test_remote_sequential_prompts(batch_size=2, seq_len=5, pre_seq_len=3):
     assert input_prompts_ref.grad is None
     assert intermediate_prompts_ref.grad is None
 
+    # Pad the prompts to the full sequence width once, so each block applies its prompt
+    # with a single full-width add instead of a strided slice assignment
+    prompts_padded = F.pad(intermediate_prompts_ref, (0, 0, 0, seq_len))
+
     outputs_ref = torch.cat([inputs, input_prompts_ref], dim=1)
     for block_index in range(config.n_layer):
-        block_prompt = intermediate_prompts_ref[block_index]
-        outputs_ref[:, : block_prompt.shape[1]] += block_prompt
+        outputs_ref = outputs_ref + prompts_padded[block_index]
 
         block = load_pretrained_block(MODEL_NAME, block_index=block_index, torch_dtype=torch.float32)
         (outputs_ref,) = block(outputs_ref)